@@ -1,20 +1,64 @@
-import json
-import copy
+import os
+import csv
 import random
 import logging
 import argparse
-import pandas as pd
+import functools
+import pyarrow.compute as pc
 from datasets import load_dataset
 from collections import Counter
 from collections import defaultdict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from sys import intern
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
 
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def load_wmt24pp(config):
+    # keep_in_memory=False keeps the split memory-mapped from the on-disk
+    # arrow cache, so repeated loads of the same config are free
+    return load_dataset("google/wmt24pp", config, keep_in_memory=False)["train"]
+
+
+CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def parse_chunk(chunk):
+    return [loads(line) for line in chunk.splitlines()]
+
+
+def generate_chunks(f_in):
+    while True:
+        chunk = f_in.read(CHUNK_BYTES)
+        if not chunk:
+            return
+        # extend to the next newline so no line straddles two chunks
+        chunk += f_in.readline()
+        yield chunk
+
+
 def generate_from_jsonl(input_path):
-    with open(input_path) as f_in:
-        for line in f_in:
-            yield json.loads(line)
+    # JSON decoding dominates ingestion and is independent per line, so
+    # parse newline-aligned chunks in worker processes; binary mode lets
+    # orjson parse the raw bytes without an extra decode
+    max_workers = max(1, (os.cpu_count() or 2) // 2)
+    with open(input_path, "rb") as f_in:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            # keep a bounded number of chunks in flight to cap memory
+            pending = deque()
+            for chunk in generate_chunks(f_in):
+                pending.append(pool.submit(parse_chunk, chunk))
+                if len(pending) >= 2 * max_workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
 
 
 def assert_span_type(esa_span):
@@ -28,7 +72,8 @@ def assert_span_type(esa_span):
 
 
 def correct_span(error_span, hypothesis):
-    error_span = copy.deepcopy(error_span)
+    # spans are flat dicts of ints/strings, so a shallow copy is enough
+    error_span = dict(error_span)
     if error_span["severity"] == "critical":
         error_span["severity"] = "major"
 
@@ -49,36 +94,92 @@ def correct_span(error_span, hypothesis):
     return error_span
 
 
+_VALID_SEVERITIES = frozenset(("major", "minor", "critical"))
+
+
 def is_invalid_span(error_span, hypothesis):
+    if error_span["severity"] not in _VALID_SEVERITIES:
+        return True
     start_i = error_span["start_i"]
     end_i = error_span["end_i"]
-    severity = error_span["severity"]
-    if isinstance(start_i, str) and start_i != "missing":
-        return True
-    if isinstance(end_i, str) and end_i != "missing":
+    # fast path: both indices are plain ints, so one chained comparison
+    # covers the four range checks and the ordering check
+    if type(start_i) is int and type(end_i) is int:
+        return not (0 <= start_i <= end_i <= len(hypothesis))
+    if type(start_i) is int:
+        if (start_i < 0) or (len(hypothesis) < start_i):
+            return True
+    elif start_i != "missing":
         return True
-    if isinstance(start_i, int) and ((start_i < 0) or (len(hypothesis) < start_i)):
-        return True
-    if isinstance(end_i, int) and ((end_i < 0) or (len(hypothesis) < end_i)):
-        return True
-    if (isinstance(start_i, int) and isinstance(end_i, int)) and (start_i > end_i):
-        return True
-    if severity not in ("major", "minor", "critical"):
+    if type(end_i) is int:
+        if (end_i < 0) or (len(hypothesis) < end_i):
+            return True
+    elif end_i != "missing":
         return True
     return False
 
 
+def classify_span(esa_span, hypothesis_len):
+    # fused assert_span_type + is_invalid_span: read the three fields once,
+    # assert the ingest contract, and report validity alongside the fields
+    start_i = esa_span["start_i"]
+    end_i = esa_span["end_i"]
+    severity = esa_span["severity"]
+    start_is_int = type(start_i) is int
+    end_is_int = type(end_i) is int
+    # type of span
+    # 1. Span indices should be "missing" or integers
+    # 2. severity should be in ["major", "minor", "undecided"]
+    assert start_is_int or ((start_i == "missing") and (end_i == "missing"))
+    assert end_is_int or ((end_i == "missing") and (start_i == "missing"))
+    assert severity in ("major", "minor", "undecided")
+
+    # Valid span:
+    # 1. has valid span indices
+    # 2. has severity with major, minor, or critical
+    if start_is_int and end_is_int:
+        valid = (0 <= start_i <= end_i <= hypothesis_len) and (
+            severity in _VALID_SEVERITIES
+        )
+    else:
+        # both indices are "missing" after the asserts above
+        valid = severity in _VALID_SEVERITIES
+    # tag decides the statistics bucket, so callers need not re-compare
+    # the indices
+    tag = "missing" if start_i == end_i else severity
+    return valid, start_i, end_i, severity, tag
+
+
+# one shared generator instead of the module-global random state
+_rng = random.Random()
+
+
 def random_valid_span(hypothesis):
-    start_i = random.randrange(len(hypothesis) + 1)
-    end_i = random.randrange(len(hypothesis) + 1)
-    while start_i == end_i:
-        end_i = random.randrange(len(hypothesis) + 1)
-    if end_i < start_i:
-        start_i, end_i = end_i, start_i
-    error_type = "major" if random.randrange(2) == 0 else "minor"
+    # sample two distinct indices at once; same distribution as the old
+    # draw/redraw/swap loop without the rejection sampling
+    start_i, end_i = sorted(_rng.sample(range(len(hypothesis) + 1), 2))
+    error_type = "major" if _rng.randrange(2) == 0 else "minor"
     return start_i, end_i, error_type
 
 
+COLS = (
+    "doc_id",
+    "segment_id",
+    "source_lang",
+    "target_lang",
+    "set_id",
+    "system_id",
+    "source_segment",
+    "hypothesis_segment",
+    "reference_segment",
+    "domain_name",
+    "method",
+    "start_indices",
+    "end_indices",
+    "error_types",
+)
+
+
 langs_to_wmt24pp_code = {
     "en-cs": "en-cs_CZ",
     "en-ja": "en-ja_JP",
@@ -98,125 +199,169 @@ def main(
     if filter_data_with_invalid_span:
         logger.info(f"filter data with invalid span: {filter_data_with_invalid_span}")
 
-    random.seed(seed)
-    log_counter = Counter()
-
-    langs_to_data = defaultdict(lambda: defaultdict(list))
+    _rng.seed(seed)
+    log_counter = {
+        "target segment is empty": 0,
+        "skip_datum_with_invalid_span": 0,
+        "num_skipped_valid_signatures": 0,
+    }
+
+    # preallocate a bucket per known language pair; data for other pairs
+    # would only be thrown away downstream, so it is never stored
+    wanted_langs = frozenset(langs_to_wmt24pp_code)
+    langs_to_data = {langs: {} for langs in langs_to_wmt24pp_code}
     for datum in generate_from_jsonl(wmt24_esa_jsonl):
+        # drop unwanted language pairs before doing any other work
+        if datum["langs"] not in wanted_langs:
+            continue
         assert len(datum["src"]) > 0
         if len(datum["tgt"]) == 0:
             log_counter["target segment is empty"] += 1
             continue
-        langs = datum["langs"]
+        bucket = langs_to_data[datum["langs"]]
+        # these fields hold a few dozen unique values across the whole
+        # corpus; interning shares one object per value while the data
+        # sits buffered in langs_to_data
+        datum["system"] = intern(datum["system"])
+        datum["domain"] = intern(datum["domain"])
+        # keep every datum per signature: whether one is emitted depends on
+        # the reference table and the span filter, which are only known
+        # downstream, so the fallback to later duplicates must stay
         signature = f"{datum['doc_id']}-{datum['line_id']}-{datum['system']}"
-        langs_to_data[langs][signature].append(datum)
+        bucket.setdefault(signature, []).append(datum)
 
     valid_signature_counter = Counter()
     for langs in langs_to_data:
         valid_signature_counter[langs] = len(langs_to_data[langs])
 
     langs_to_statistics = defaultdict(Counter)
-    data = defaultdict(list)
-    for langs in langs_to_data:
-        if langs not in langs_to_wmt24pp_code:
-            continue
-
-        # prepare references
-        wmt24pp = load_dataset("google/wmt24pp", langs_to_wmt24pp_code[langs])["train"]
-        src_to_tgt = {}
-        for datum in wmt24pp:
-            if datum["is_bad_source"]:
-                continue
-            src_to_tgt[datum["source"]] = datum["target"]
-
-        num_langs_data = 0
-        for signature in langs_to_data[langs]:
-            for datum in langs_to_data[langs][signature]:
-                # skip if there is no reference
-                if datum["src"] not in src_to_tgt:
-                    continue
-
-                start_indices = []
-                end_indices = []
-                error_types = []
-
-                has_invalid_span = False
-                esa_counter = Counter()
-                for esa_span in datum["esa_spans"]:
-                    # type of span
-                    # 1. Span indices should be "missing" or integers
-                    # 2. severity should be in ["major", "minor", "undecided"]
-                    assert_span_type(esa_span)
-
-                    # Valid span:
-                    # 1. has valid span indices
-                    # 2. has severity with major, minor, or critical
-                    if filter_data_with_invalid_span and is_invalid_span(
-                        esa_span, datum["tgt"]
-                    ):
-                        has_invalid_span = True
-                        break
-
-                    # missing
-                    if esa_span["start_i"] == esa_span["end_i"]:
-                        esa_counter["missing"] += 1
-                    else:
-                        esa_counter[esa_span["severity"]] += 1
-
-                    start_indices.append(f'{esa_span["start_i"]}')
-                    end_indices.append(f'{esa_span["end_i"]}')
-                    error_types.append(esa_span["severity"])
-
-                if has_invalid_span:
-                    log_counter["skip_datum_with_invalid_span"] += 1
-                    continue
-
-                if len(start_indices) == 0:
-                    start_indices.append("-1")
-                    end_indices.append("-1")
-                    error_types.append("no-error")
-
-                data["doc_id"].append(datum["doc_id"])
-                data["segment_id"].append(datum["line_id"])
-                source_lang, target_lang = datum["langs"].split("-")
-                data["source_lang"].append(source_lang)
-                data["target_lang"].append(target_lang)
-                data["set_id"].append("official")
-                data["system_id"].append(datum["system"])
-                data["source_segment"].append(datum["src"])
-                data["hypothesis_segment"].append(datum["tgt"])
-                data["reference_segment"].append(src_to_tgt[datum["src"]])
-                data["domain_name"].append(datum["domain"])
-                data["method"].append("ESA")
-                data["start_indices"].append(" ".join(start_indices))
-                data["end_indices"].append(" ".join(end_indices))
-                data["error_types"].append(" ".join(error_types))
-
-                if error_types[0] == "no-error":
-                    langs_to_statistics[langs]["no-error"] += 1
-
-                langs_to_statistics[langs]["major"] += esa_counter["major"]
-                langs_to_statistics[langs]["minor"] += esa_counter["minor"]
-                langs_to_statistics[langs]["missing"] += esa_counter["missing"]
-
-                num_langs_data += 1
-                # skip the same signature
-                break
-
-        logger.info(
-            f"# {langs} data: {num_langs_data} from {valid_signature_counter[langs]} valid signatures:"
-        )
-        for error_type in ["no-error", "missing", "major", "minor"]:
-            logger.info(f"- {error_type}: {langs_to_statistics[langs][error_type]}")
-
-        log_counter["num_skipped_valid_signatures"] += (
-            valid_signature_counter[langs] - num_langs_data
+    # stream accepted rows straight to the tsv instead of buffering
+    # the whole dataset in memory; the 1MB buffer batches the syscalls.
+    # QUOTE_MINIMAL stays on because segments can contain tabs/newlines
+    with open(output_path, "w", newline="", buffering=1 << 20) as f_out:
+        writer = csv.writer(
+            f_out, delimiter="\t", quoting=csv.QUOTE_MINIMAL, lineterminator="\n"
         )
+        writer.writerow(COLS)
+        for langs in langs_to_data:
+            # every key is a wanted pair now; only skip empty buckets
+            if not langs_to_data[langs]:
+                continue
 
-    for option_name in log_counter:
-        logger.info(f"# {option_name}: {log_counter[option_name]}")
-
-    pd.DataFrame(data).to_csv(output_path, sep="\t", index=False, header=True)
+            # prepare references; filter bad sources at the arrow level
+            # instead of decoding the dataset row by row
+            wmt24pp = load_wmt24pp(langs_to_wmt24pp_code[langs])
+            tbl = wmt24pp.data.table
+            mask = pc.invert(tbl.column("is_bad_source"))
+            src_to_tgt = dict(
+                zip(
+                    tbl.column("source").filter(mask).to_pylist(),
+                    tbl.column("target").filter(mask).to_pylist(),
+                )
+            )
+
+            # bind the hot helper to a local so the span loop does
+            # LOAD_FAST instead of LOAD_GLOBAL per call
+            _classify_span = classify_span
+
+            # constant within this language
+            source_lang, target_lang = langs.split("-")
+
+            num_langs_data = 0
+            for data_for_signature in langs_to_data[langs].values():
+                for datum in data_for_signature:
+                    # skip if there is no reference; single lookup instead of
+                    # membership check plus subscript at row emit
+                    reference = src_to_tgt.get(datum["src"])
+                    if reference is None:
+                        continue
+
+                    start_indices = []
+                    end_indices = []
+                    error_types = []
+                    _si_append = start_indices.append
+                    _ei_append = end_indices.append
+                    _et_append = error_types.append
+
+                    has_invalid_span = False
+                    # plain dict with preset keys: the increment is a single
+                    # subscript, no Counter.__missing__ dispatch
+                    esa_counter = {
+                        "missing": 0,
+                        "major": 0,
+                        "minor": 0,
+                        "undecided": 0,
+                    }
+                    tgt_len = len(datum["tgt"])
+                    for esa_span in datum["esa_spans"]:
+                        valid, start_i, end_i, severity, tag = _classify_span(
+                            esa_span, tgt_len
+                        )
+                        if filter_data_with_invalid_span and not valid:
+                            has_invalid_span = True
+                            break
+
+                        esa_counter[tag] += 1
+
+                        # keep the raw values; formatting happens once at the
+                        # join below via a C-level map(str, ...)
+                        _si_append(start_i)
+                        _ei_append(end_i)
+                        _et_append(severity)
+
+                    if has_invalid_span:
+                        log_counter["skip_datum_with_invalid_span"] += 1
+                        continue
+
+                    if len(start_indices) == 0:
+                        start_indices.append(-1)
+                        end_indices.append(-1)
+                        error_types.append("no-error")
+
+                    writer.writerow(
+                        (
+                            datum["doc_id"],
+                            datum["line_id"],
+                            source_lang,
+                            target_lang,
+                            "official",
+                            datum["system"],
+                            datum["src"],
+                            datum["tgt"],
+                            reference,
+                            datum["domain"],
+                            "ESA",
+                            " ".join(map(str, start_indices)),
+                            " ".join(map(str, end_indices)),
+                            " ".join(error_types),
+                        )
+                    )
+
+                    if error_types[0] == "no-error":
+                        langs_to_statistics[langs]["no-error"] += 1
+
+                    langs_to_statistics[langs]["major"] += esa_counter["major"]
+                    langs_to_statistics[langs]["minor"] += esa_counter["minor"]
+                    langs_to_statistics[langs]["missing"] += esa_counter["missing"]
+
+                    num_langs_data += 1
+                    # skip the same signature
+                    break
+
+            logger.info(
+                f"# {langs} data: {num_langs_data} from {valid_signature_counter[langs]} valid signatures:"
+            )
+            for error_type in ["no-error", "missing", "major", "minor"]:
+                logger.info(f"- {error_type}: {langs_to_statistics[langs][error_type]}")
+
+            log_counter["num_skipped_valid_signatures"] += (
+                valid_signature_counter[langs] - num_langs_data
+            )
+
+    for option_name, count in log_counter.items():
+        if count == 0:
+            continue
+        logger.info(f"# {option_name}: {count}")
 
 
 def parse_args():
@@ -28,8 +28,8 @@ WMT24_ESA_JSONL=wmt24_esa.jsonl
 REFERENCES_TSV=wmt24_esa.tsv
 
 uv run --python 3.11 \
-    --with pandas \
     --with datasets \
+    --with orjson \
     create_tsv_from_wmt24_esa.py \
     --wmt24_esa_jsonl $WMT24_ESA_JSONL \
     --output_tsv $REFERENCES_TSV \